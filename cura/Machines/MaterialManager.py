@@ -1,16 +1,16 @@
 # Copyright (c) 2019 Ultimaker B.V.
 # Cura is released under the terms of the LGPLv3 or higher.
 
-from collections import defaultdict
+import bisect
 import copy
 import uuid
-from typing import Dict, Optional, TYPE_CHECKING, Any, List, cast
+from weakref import WeakKeyDictionary, WeakSet
+from typing import Dict, Optional, TYPE_CHECKING, Any, List, Set, Tuple, cast
 
 from PyQt5.Qt import QTimer, QObject, pyqtSignal, pyqtSlot
 
 from UM.Decorators import deprecated
 from UM.Logger import Logger
-from UM.Settings.ContainerRegistry import ContainerRegistry
 from UM.Util import parseBool
 import cura.CuraApplication  # Imported like this to prevent circular imports.
 from cura.Machines.ContainerTree import ContainerTree
@@ -24,6 +24,8 @@ if TYPE_CHECKING:
     from UM.Settings.InstanceContainer import InstanceContainer
     from cura.Settings.GlobalStack import GlobalStack
     from cura.Settings.ExtruderStack import ExtruderStack
+    from cura.Machines.Models.MaterialManagementModel import MaterialManagementModel
+    from cura.Machines.MachineNode import MachineNode
 
 
 #
@@ -51,8 +53,15 @@ class MaterialManager(QObject):
 
     def __init__(self, parent = None):
         super().__init__(parent)
-        # Material_type -> generic material metadata
-        self._fallback_materials_map = dict()  # type: Dict[str, Dict[str, Any]]
+        self._app = cura.CuraApplication.CuraApplication.getInstance()
+        self._prefs = self._app.getPreferences()
+        self._container_registry = CuraContainerRegistry.getInstance()
+        self._cached_material_management_model = None  # type: Optional[MaterialManagementModel]
+        self._container_tree_machines = None  # type: Optional[Dict[str, MachineNode]]
+
+        # Fallback (generic) material IDs, and material_type -> index of its fallback material in that list
+        self._fb_ids = []  # type: List[str]
+        self._fb_type_to_idx = dict()  # type: Dict[str, int]
 
         # Root_material_id -> MaterialGroup
         self._material_group_map = dict()  # type: Dict[str, MaterialGroup]
@@ -61,11 +70,35 @@ class MaterialManager(QObject):
         self._diameter_material_map = dict()  # type: Dict[str, str]
 
         # This is used in Legacy UM3 send material function and the material management page.
-        # GUID -> a list of material_groups
-        self._guid_material_groups_map = defaultdict(list)  # type: Dict[str, List[MaterialGroup]]
-
-        self._favorites = set(cura.CuraApplication.CuraApplication.getInstance().getPreferences().getValue("cura/favorite_materials").split(";"))
-        self.materialsUpdated.emit()
+        # All material groups sorted by GUID, and GUID -> (start, end) range of its material groups in that list.
+        self._guid_flat = ()  # type: Tuple[MaterialGroup, ...]
+        self._guid_ranges = dict()  # type: Dict[str, Tuple[int, int]]
+
+        # Lookups for material containers in the registry. These are built on first use and kept up to date as
+        # material containers change, so that they don't need to be found by scanning the container registry.
+        # Material ID -> material metadata
+        self._id_to_metadata = dict()  # type: Dict[str, Dict[str, Any]]
+        # Material ID -> the keys under which it is stored in the diameter lookup and the base file lookup
+        self._id_to_lookup_keys = dict()  # type: Dict[str, Tuple[Tuple[str, str, str, str, str], str]]
+        # Material ID -> position in the order in which the materials were found in the registry
+        self._id_to_order = dict()  # type: Dict[str, int]
+        self._next_material_order = 0
+        # (brand, definition, material, color_name, approximate_diameter) -> (order, material ID) of all materials
+        # with that key, sorted by order
+        self._diameter_lookup = dict()  # type: Dict[Tuple[str, str, str, str, str], List[Tuple[int, str]]]
+        # Base file -> IDs of all materials with that base file
+        self._base_file_to_ids = dict()  # type: Dict[str, Set[str]]
+        # Material ID -> approximate diameter, already converted to a float
+        self._material_diameter_f = dict()  # type: Dict[str, float]
+        self._material_lookups_built = False
+
+        # Extruder stack -> rounded compatible material diameter, see _computeAndCacheDiameter.
+        self._diameter_cache = WeakKeyDictionary()  # type: WeakKeyDictionary[ExtruderStack, int]
+        self._diameter_cache_watched_stacks = WeakSet()  # type: WeakSet[ExtruderStack]
+
+        # The favorites are only read from the preferences when they are first needed, see _ensureFavorites.
+        self._favorites_serialized = ""
+        self._favorites = None  # type: Optional[Set[str]]
 
         self._update_timer = QTimer(self)
         self._update_timer.setInterval(300)
@@ -73,42 +106,173 @@ class MaterialManager(QObject):
         self._update_timer.setSingleShot(True)
         self._update_timer.timeout.connect(self.materialsUpdated)
 
-        container_registry = ContainerRegistry.getInstance()
-        container_registry.containerMetaDataChanged.connect(self._onContainerMetadataChanged)
-        container_registry.containerAdded.connect(self._onContainerMetadataChanged)
-        container_registry.containerRemoved.connect(self._onContainerMetadataChanged)
+        # Toggling favorites in quick succession shouldn't write the preferences file for every single click.
+        self._favorites_save_timer = QTimer(self)
+        self._favorites_save_timer.setInterval(300)
+        self._favorites_save_timer.setSingleShot(True)
+        self._favorites_save_timer.timeout.connect(self._flushFavorites)
+        self._prefs.preferenceChanged.connect(self._onPreferenceChanged)
 
-    def _onContainerMetadataChanged(self, container):
-        self._onContainerChanged(container)
+        self._container_registry.containerMetaDataChanged.connect(self._onContainerChanged)
+        self._container_registry.containerAdded.connect(self._onContainerChanged)
+        self._container_registry.containerRemoved.connect(self._onContainerRemoved)
 
+    # These are called for every container in the registry, most of which are not materials, so bail out as soon as
+    # possible.
     def _onContainerChanged(self, container):
-        container_type = container.getMetaDataEntry("type")
-        if container_type != "material":
+        metadata = container.getMetaData()
+        if metadata.get("type") != "material":
             return
 
         # update the maps
+        if self._material_lookups_built:
+            self._updateMaterialLookups(metadata)
+
+        self._markDirty()
+
+    def _onContainerRemoved(self, container):
+        if container.getMetaData().get("type") != "material":
+            return
 
-        self._update_timer.start()
+        if self._material_lookups_built:
+            self._removeFromMaterialLookups(container.getId())
+
+        self._markDirty()
+
+    ##  Schedules a materialsUpdated signal. The timer is not restarted while
+    #   it is already running, so a flood of changes (e.g. when loading a
+    #   project) doesn't keep pushing the update back.
+    def _markDirty(self) -> None:
+        if not self._update_timer.isActive():
+            self._update_timer.start()
+
+    @staticmethod
+    def _getDiameterLookupKey(metadata: Dict[str, Any]) -> Tuple[str, str, str, str, str]:
+        return metadata.get("brand", ""), metadata.get("definition", ""), metadata.get("material", ""), metadata.get("color_name", ""), metadata.get("approximate_diameter", "")
+
+    def _buildMaterialLookups(self) -> None:
+        self._id_to_metadata = dict()
+        self._id_to_lookup_keys = dict()
+        self._id_to_order = dict()
+        self._next_material_order = 0
+        self._diameter_lookup = dict()
+        self._base_file_to_ids = dict()
+        self._material_diameter_f = dict()
+        for metadata in self._container_registry.findInstanceContainersMetadata(type = "material"):
+            self._addToMaterialLookups(metadata)
+        self._material_lookups_built = True
+
+    ##  Brings the lookups up to date for a material that was added or whose
+    #   metadata changed. If the keys it is stored under didn't change (e.g.
+    #   it got renamed), it stays where it is.
+    def _updateMaterialLookups(self, metadata: Dict[str, Any]) -> None:
+        material_id = metadata["id"]
+        if self._id_to_lookup_keys.get(material_id) == (self._getDiameterLookupKey(metadata), metadata.get("base_file", "")):
+            self._id_to_metadata[material_id] = metadata
+            self._cacheMaterialDiameter(material_id, metadata)
+            return
+        self._removeFromMaterialLookups(material_id, keep_order = True)
+        self._addToMaterialLookups(metadata)
+
+    def _addToMaterialLookups(self, metadata: Dict[str, Any]) -> None:
+        material_id = metadata["id"]
+        order = self._id_to_order.get(material_id)
+        if order is None:  # New materials come after all materials that are already in the registry.
+            order = self._next_material_order
+            self._next_material_order += 1
+            self._id_to_order[material_id] = order
+        diameter_key = self._getDiameterLookupKey(metadata)
+        base_file = metadata.get("base_file", "")
+        self._id_to_metadata[material_id] = metadata
+        # The metadata dict may be changed in place later on, so remember under which keys this material was stored.
+        self._id_to_lookup_keys[material_id] = (diameter_key, base_file)
+        # If multiple materials share the same key, the first one in registry order wins.
+        bisect.insort(self._diameter_lookup.setdefault(diameter_key, []), (order, material_id))
+        self._base_file_to_ids.setdefault(base_file, set()).add(material_id)
+        self._cacheMaterialDiameter(material_id, metadata)
+
+    ##  Removes a material from the lookups.
+    #   \param material_id The ID of the material to remove.
+    #   \param keep_order Whether the material keeps its position in the
+    #   registry order, for when it is added back right away.
+    def _removeFromMaterialLookups(self, material_id: str, keep_order: bool = False) -> None:
+        self._id_to_metadata.pop(material_id, None)
+        self._material_diameter_f.pop(material_id, None)
+        lookup_keys = self._id_to_lookup_keys.pop(material_id, None)
+        if keep_order:
+            order = self._id_to_order.get(material_id)
+        else:
+            order = self._id_to_order.pop(material_id, None)
+        if lookup_keys is None:
+            return
+        diameter_key, base_file = lookup_keys
+
+        ids = self._base_file_to_ids.get(base_file)
+        if ids is not None:
+            ids.discard(material_id)
+            if not ids:
+                del self._base_file_to_ids[base_file]
+
+        # The next material with the same key, if any, becomes the first one.
+        entries = self._diameter_lookup.get(diameter_key)
+        if entries is not None:
+            entries.remove((order, material_id))
+            if not entries:
+                del self._diameter_lookup[diameter_key]
+
+    def _cacheMaterialDiameter(self, material_id: str, metadata: Dict[str, Any]) -> None:
+        self._material_diameter_f.pop(material_id, None)
+        approximate_diameter = metadata.get("approximate_diameter")
+        if approximate_diameter is None:  # Such as the empty material.
+            return
+        try:
+            self._material_diameter_f[material_id] = float(approximate_diameter)
+        except (TypeError, ValueError):
+            Logger.log("w", "Material %s has an invalid approximate diameter", material_id)
+
+    ##  The material management model of the application. It may not exist yet
+    #   when this manager is created, so it is only fetched on first use.
+    @property
+    def _material_management_model(self) -> "MaterialManagementModel":
+        if self._cached_material_management_model is None:
+            self._cached_material_management_model = self._app.getMaterialManagementModel()
+        return self._cached_material_management_model
+
+    ##  The machine nodes of the container tree, by definition ID. The tree
+    #   only ever adds to this dict and never replaces it, so the reference
+    #   can be kept. It is fetched on first use, since getting the container
+    #   tree may build it.
+    def _getContainerTreeMachines(self) -> Dict[str, "MachineNode"]:
+        if self._container_tree_machines is None:
+            self._container_tree_machines = ContainerTree.getInstance().machines
+        return self._container_tree_machines
 
     def getMaterialGroup(self, root_material_id: str) -> Optional[MaterialGroup]:
         return self._material_group_map.get(root_material_id)
 
     def getRootMaterialIDForDiameter(self, root_material_id: str, approximate_diameter: str) -> str:
-        original_material = CuraContainerRegistry.getInstance().findInstanceContainersMetadata(id=root_material_id)[0]
+        if not self._material_lookups_built:
+            self._buildMaterialLookups()
+
+        original_material = self._id_to_metadata[root_material_id]
         if original_material["approximate_diameter"] == approximate_diameter:
             return root_material_id
 
-        matching_materials = CuraContainerRegistry.getInstance().findInstanceContainersMetadata(type = "material", brand = original_material["brand"], definition = original_material["definition"], material = original_material["material"], color_name = original_material["color_name"])
-        for material in matching_materials:
-            if material["approximate_diameter"] == approximate_diameter:
-                return material["id"]
-        return root_material_id
+        key = self._getDiameterLookupKey(original_material)[:-1] + (approximate_diameter, )
+        entries = self._diameter_lookup.get(key)
+        if not entries:
+            return root_material_id
+        return entries[0][1]
 
     def getRootMaterialIDWithoutDiameter(self, root_material_id: str) -> str:
         return self._diameter_material_map.get(root_material_id, "")
 
-    def getMaterialGroupListByGUID(self, guid: str) -> Optional[List[MaterialGroup]]:
-        return self._guid_material_groups_map.get(guid)
+    def getMaterialGroupListByGUID(self, guid: str) -> Optional[Tuple[MaterialGroup, ...]]:
+        material_group_range = self._guid_ranges.get(guid)
+        if material_group_range is None:
+            return None
+        start, end = material_group_range
+        return self._guid_flat[start:end]
 
     # Returns a dict of all material groups organized by root_material_id.
     def getAllMaterialGroups(self) -> Dict[str, "MaterialGroup"]:
@@ -118,7 +282,7 @@ class MaterialManager(QObject):
     #   MaterialNodes from the ContainerTree that are available for the given
     #   printer and variant.
     def getAvailableMaterials(self, definition_id: str, nozzle_name: Optional[str]) -> Dict[str, MaterialNode]:
-        return ContainerTree.getInstance().machines[definition_id].variants[nozzle_name].materials
+        return self._getContainerTreeMachines()[definition_id].variants[nozzle_name].materials
 
     #
     # A convenience function to get available materials for the given machine with the extruder position.
@@ -132,7 +296,10 @@ class MaterialManager(QObject):
         # Fetch the available materials (ContainerNode) for the current active machine and extruder setup.
         materials = self.getAvailableMaterials(machine.definition.getId(), nozzle_name)
         compatible_material_diameter = extruder_stack.getApproximateMaterialDiameter()
-        result = {key: material for key, material in materials.items() if material.container and float(material.container.getMetaDataEntry("approximate_diameter")) == compatible_material_diameter}
+        if not self._material_lookups_built:
+            self._buildMaterialLookups()
+        material_diameters = self._material_diameter_f
+        result = {key: material for key, material in materials.items() if material.container and material_diameters.get(material.container_id) == compatible_material_diameter}
         return result
 
     #
@@ -143,24 +310,27 @@ class MaterialManager(QObject):
     #
     def getMaterialNode(self, machine_definition_id: str, nozzle_name: Optional[str],
                         buildplate_name: Optional[str], diameter: float, root_material_id: str) -> Optional["MaterialNode"]:
-        container_tree = ContainerTree.getInstance()
-        machine_node = container_tree.machines.get(machine_definition_id)
+        try:
+            return self._getContainerTreeMachines()[machine_definition_id].variants[nozzle_name].materials[root_material_id]
+        except KeyError:
+            self._logMaterialNodeMiss(machine_definition_id, nozzle_name, root_material_id)
+            return None
+
+    ##  Logs which part of the container tree is missing when getMaterialNode
+    #   couldn't find a material node. This is kept out of getMaterialNode so
+    #   the common case where the node exists stays short.
+    def _logMaterialNodeMiss(self, machine_definition_id: str, nozzle_name: Optional[str], root_material_id: str) -> None:
+        machine_node = self._getContainerTreeMachines().get(machine_definition_id)
         if machine_node is None:
             Logger.log("w", "Could not find machine with definition %s in the container tree", machine_definition_id)
-            return None
+            return
 
         variant_node = machine_node.variants.get(nozzle_name)
         if variant_node is None:
             Logger.log("w", "Could not find variant %s for machine with definition %s in the container tree", nozzle_name, machine_definition_id )
-            return None
-
-        material_node = variant_node.materials.get(root_material_id)
-
-        if material_node is None:
-            Logger.log("w", "Could not find material %s for machine with definition %s and variant %s in the container tree", root_material_id, machine_definition_id, nozzle_name)
-            return None
+            return
 
-        return material_node
+        Logger.log("w", "Could not find material %s for machine with definition %s and variant %s in the container tree", root_material_id, machine_definition_id, nozzle_name)
 
     #
     # Gets MaterialNode for the given extruder and machine with the given material type.
@@ -170,29 +340,37 @@ class MaterialManager(QObject):
     #
     def getMaterialNodeByType(self, global_stack: "GlobalStack", position: str, nozzle_name: str,
                               buildplate_name: Optional[str], material_guid: str) -> Optional["MaterialNode"]:
-        machine_definition = global_stack.definition
-        extruder = global_stack.extruderList[int(position)]
-        variant_name = extruder.variant.getName()
-        approximate_diameter = extruder.getApproximateMaterialDiameter()
+        machine_definition_id = global_stack.definition.getId()
+        variant_name = global_stack.extruders[position].variant.getName()
 
-        return self.getMaterialNode(machine_definition.getId(), variant_name, buildplate_name, approximate_diameter, material_guid)
+        # Same lookup as getMaterialNode. The material diameter isn't needed to find the node, so it's not evaluated.
+        try:
+            return self._getContainerTreeMachines()[machine_definition_id].variants[variant_name].materials[material_guid]
+        except KeyError:
+            self._logMaterialNodeMiss(machine_definition_id, variant_name, material_guid)
+            return None
 
     #   There are 2 ways to get fallback materials;
     #   - A fallback by type (@sa getFallbackMaterialIdByMaterialType), which adds the generic version of this material
     #   - A fallback by GUID; If a material has been duplicated, it should also check if the original materials do have
     #       a GUID. This should only be done if the material itself does not have a quality just yet.
     def getFallBackMaterialIdsByMaterial(self, material: "InstanceContainer") -> List[str]:
-        results = []  # type: List[str]
-
-        material_groups = self.getMaterialGroupListByGUID(material.getMetaDataEntry("GUID"))
-        for material_group in material_groups:  # type: ignore
-            if material_group.name != material.getId():
-                # If the material in the group is read only, put it at the front of the list (since that is the most
-                # likely one to get a result)
+        # If the material in the group is read only, put it at the front of the list (since that is the most likely one
+        # to get a result)
+        read_only_results = []  # type: List[str]
+        other_results = []  # type: List[str]
+
+        material_id = material.getId()
+        material_groups = self.getMaterialGroupListByGUID(material.getMetaDataEntry("GUID")) or ()
+        for material_group in material_groups:
+            if material_group.name != material_id:
                 if material_group.is_read_only:
-                    results.insert(0, material_group.name)
+                    read_only_results.append(material_group.name)
                 else:
-                    results.append(material_group.name)
+                    other_results.append(material_group.name)
+        # The read only materials used to be inserted at the front one by one, so they end up in reverse order.
+        read_only_results.reverse()
+        results = read_only_results + other_results
 
         fallback = self.getFallbackMaterialIdByMaterialType(material.getMetaDataEntry("material"))
         if fallback is not None:
@@ -213,67 +391,91 @@ class MaterialManager(QObject):
     # "ABS", etc.
     #
     def getFallbackMaterialIdByMaterialType(self, material_type: str) -> Optional[str]:
+        idx = self._fb_type_to_idx.get(material_type)
         # For safety
-        if material_type not in self._fallback_materials_map:
+        if idx is None:
             Logger.log("w", "The material type [%s] does not have a fallback material" % material_type)
             return None
-        fallback_material = self._fallback_materials_map[material_type]
-        if fallback_material:
-            return self.getRootMaterialIDWithoutDiameter(fallback_material["id"])
-        else:
-            return None
+        return self.getRootMaterialIDWithoutDiameter(self._fb_ids[idx])
 
     ##  Get default material for given global stack, extruder position and extruder nozzle name
     #   you can provide the extruder_definition and then the position is ignored (useful when building up global stack in CuraStackBuilder)
     def getDefaultMaterial(self, global_stack: "GlobalStack", position: str, nozzle_name: Optional[str],
                            extruder_definition: Optional["DefinitionContainer"] = None) -> "MaterialNode":
         definition_id = global_stack.definition.getId()
-        machine_node = ContainerTree.getInstance().machines[definition_id]
-        if nozzle_name in machine_node.variants:
-            nozzle_node = machine_node.variants[nozzle_name]
-        else:
+        machine_node = self._getContainerTreeMachines()[definition_id]
+        nozzle_node = machine_node.variants.get(nozzle_name)
+        if nozzle_node is None:
             Logger.log("w", "Could not find variant {nozzle_name} for machine with definition {definition_id} in the container tree".format(nozzle_name = nozzle_name, definition_id = definition_id))
-            nozzle_node = next(iter(machine_node.variants))
+            nozzle_node = next(iter(machine_node.variants.values()))
 
         if not parseBool(global_stack.getMetaDataEntry("has_materials", False)):
-            return next(iter(nozzle_node.materials))
+            return next(iter(nozzle_node.materials.values()))
 
         if extruder_definition is not None:
-            material_diameter = extruder_definition.getProperty("material_diameter", "value")
+            approximate_material_diameter = round(extruder_definition.getProperty("material_diameter", "value"))
         else:
-            material_diameter = global_stack.extruders[position].getCompatibleMaterialDiameter()
-        approximate_material_diameter = round(material_diameter)
+            extruder_stack = global_stack.extruders[position]
+            approximate_material_diameter = self._diameter_cache.get(extruder_stack)
+            if approximate_material_diameter is None:
+                approximate_material_diameter = self._computeAndCacheDiameter(extruder_stack)
 
         return nozzle_node.preferredMaterial(approximate_material_diameter)
 
+    ##  Computes the rounded compatible material diameter of an extruder and
+    #   remembers it until the material diameter or the containers of any
+    #   watched extruder change.
+    def _computeAndCacheDiameter(self, extruder_stack: "ExtruderStack") -> int:
+        if extruder_stack not in self._diameter_cache_watched_stacks:
+            # compatibleMaterialDiameterChanged is emitted right away by setCompatibleMaterialDiameter. Property changes
+            # are only emitted later on, but also cover the setting being changed in some other way.
+            extruder_stack.compatibleMaterialDiameterChanged.connect(self._onExtruderCompatibleMaterialDiameterChanged)
+            extruder_stack.propertyChanged.connect(self._onExtruderPropertyChanged)
+            extruder_stack.containersChanged.connect(self._onExtruderContainersChanged)
+            self._diameter_cache_watched_stacks.add(extruder_stack)
+        approximate_material_diameter = round(extruder_stack.getCompatibleMaterialDiameter())
+        self._diameter_cache[extruder_stack] = approximate_material_diameter
+        return approximate_material_diameter
+
+    # The signals don't tell which extruder changed, so the whole (small) cache is cleared.
+    def _onExtruderCompatibleMaterialDiameterChanged(self) -> None:
+        self._diameter_cache.clear()
+
+    def _onExtruderPropertyChanged(self, key: str, property_name: str) -> None:
+        if key == "material_diameter":
+            self._diameter_cache.clear()
+
+    def _onExtruderContainersChanged(self, container) -> None:
+        self._diameter_cache.clear()
+
     def removeMaterialByRootId(self, root_material_id: str):
-        container_registry = CuraContainerRegistry.getInstance()
-        results = container_registry.findContainers(id = root_material_id)
+        results = self._container_registry.findContainers(id = root_material_id)
         if not results:
-            container_registry.addWrongContainerId(root_material_id)
+            self._container_registry.addWrongContainerId(root_material_id)
 
         for result in results:
-            container_registry.removeContainer(result.getMetaDataEntry("id", ""))
+            self._container_registry.removeContainer(result.getMetaDataEntry("id", ""))
 
     @pyqtSlot("QVariant", result = bool)
     def canMaterialBeRemoved(self, material_node: "MaterialNode"):
         # Check if the material is active in any extruder train. In that case, the material shouldn't be removed!
         # In the future we might enable this again, but right now, it's causing a ton of issues if we do (since it
         # corrupts the configuration)
+        if not self._material_lookups_built:
+            self._buildMaterialLookups()
+
         root_material_id = material_node.base_file
-        ids_to_remove = {metadata.get("id", "") for metadata in CuraContainerRegistry.getInstance().findInstanceContainersMetadata(base_file = root_material_id)}
+        ids_to_remove = self._base_file_to_ids.get(root_material_id, set())
 
-        for extruder_stack in CuraContainerRegistry.getInstance().findContainerStacks(type = "extruder_train"):
-            if extruder_stack.material.getId() in ids_to_remove:
-                return False
-        return True
+        active_material_ids = {extruder_stack.material.getId() for extruder_stack in self._container_registry.findContainerStacks(type = "extruder_train")}
+        return ids_to_remove.isdisjoint(active_material_ids)
 
     ##  Change the user-visible name of a material.
     #   \param material_node The ContainerTree node of the material to rename.
     #   \param name The new name for the material.
     @pyqtSlot("QVariant", str)
     def setMaterialName(self, material_node: "MaterialNode", name: str) -> None:
-        return cura.CuraApplication.CuraApplication.getMaterialManagementModel().setMaterialName(material_node, name)
+        return self._material_management_model.setMaterialName(material_node, name)
 
     ##  Deletes a material from Cura.
     #
@@ -287,10 +489,10 @@ class MaterialManager(QObject):
     #   \param material_node The material to remove.
     @pyqtSlot("QVariant")
     def removeMaterial(self, material_node: "MaterialNode") -> None:
-        return cura.CuraApplication.CuraApplication.getMaterialManagementModel().setMaterialName(material_node)
+        return self._material_management_model.removeMaterial(material_node)
 
     def duplicateMaterialByRootId(self, root_material_id: str, new_base_id: Optional[str] = None, new_metadata: Optional[Dict[str, Any]] = None) -> Optional[str]:
-        result = cura.CuraApplication.CuraApplication.getInstance().getMaterialManagementModel().duplicateMaterialByBaseFile(root_material_id, new_base_id, new_metadata)
+        result = self._material_management_model.duplicateMaterialByBaseFile(root_material_id, new_base_id, new_metadata)
         if result is None:
             return "ERROR"
         return result
@@ -306,7 +508,7 @@ class MaterialManager(QObject):
     #   \return The root material ID of the duplicate material.
     @pyqtSlot("QVariant", result = str)
     def duplicateMaterial(self, material_node: MaterialNode, new_base_id: Optional[str] = None, new_metadata: Optional[Dict[str, Any]] = None) -> str:
-        result = cura.CuraApplication.CuraApplication.getInstance().getMaterialManagementModel().duplicateMaterial(material_node, new_base_id, new_metadata)
+        result = self._material_management_model.duplicateMaterial(material_node, new_base_id, new_metadata)
         if result is None:
             return "ERROR"
         return result
@@ -320,30 +522,61 @@ class MaterialManager(QObject):
     #   \return The ID of the newly created material.
     @pyqtSlot(result = str)
     def createMaterial(self) -> str:
-        return cura.CuraApplication.CuraApplication.getMaterialManagementModel().createMaterial()
+        return self._material_management_model.createMaterial()
 
     @pyqtSlot(str)
     def addFavorite(self, root_material_id: str) -> None:
-        self._favorites.add(root_material_id)
-        self.materialsUpdated.emit()
-
-        # Ensure all settings are saved.
-        cura.CuraApplication.CuraApplication.getInstance().getPreferences().setValue("cura/favorite_materials", ";".join(list(self._favorites)))
-        cura.CuraApplication.CuraApplication.getInstance().saveSettings()
+        favorites = self._ensureFavorites()
+        if root_material_id in favorites:
+            return
+        favorites.add(root_material_id)
+        # Appending is enough here, only removing a favorite requires the whole string to be rebuilt.
+        if self._favorites_serialized:
+            self._favorites_serialized = self._favorites_serialized + ";" + root_material_id
+        else:
+            self._favorites_serialized = root_material_id
+        self._prefs.setValue("cura/favorite_materials", self._favorites_serialized)
+        self._favorites_save_timer.start()
 
     @pyqtSlot(str)
     def removeFavorite(self, root_material_id: str) -> None:
+        favorites = self._ensureFavorites()
         try:
-            self._favorites.remove(root_material_id)
+            favorites.remove(root_material_id)
         except KeyError:
             Logger.log("w", "Could not delete material %s from favorites as it was already deleted", root_material_id)
             return
+        self._favorites_serialized = ";".join(favorites)
+        self._prefs.setValue("cura/favorite_materials", self._favorites_serialized)
+        self._favorites_save_timer.start()
+
+    ##  Writes the settings to disk and notifies listeners after the favorites
+    #   changed. This is triggered by the favorites save timer, so that a burst
+    #   of changes results in a single write. The preference itself is always
+    #   updated right away.
+    def _flushFavorites(self) -> None:
         self.materialsUpdated.emit()
 
         # Ensure all settings are saved.
-        cura.CuraApplication.CuraApplication.getInstance().getPreferences().setValue("cura/favorite_materials", ";".join(list(self._favorites)))
-        cura.CuraApplication.CuraApplication.getInstance().saveSettings()
+        self._app.saveSettings()
+
+    ##  The favorites can also be changed by others, such as the
+    #   MaterialManagementModel. In that case they are read again on next use.
+    def _onPreferenceChanged(self, preference_key: str) -> None:
+        if preference_key != "cura/favorite_materials" or self._favorites is None:
+            return
+        if self._prefs.getValue("cura/favorite_materials") != self._favorites_serialized:
+            self._favorites = None
 
     @pyqtSlot()
     def getFavorites(self):
+        return self._ensureFavorites()
+
+    ##  Reads the favorites from the preferences the first time they are
+    #   needed.
+    #   \return The set of favorite root material IDs.
+    def _ensureFavorites(self) -> Set[str]:
+        if self._favorites is None:
+            self._favorites_serialized = self._prefs.getValue("cura/favorite_materials") or ""
+            self._favorites = set(self._favorites_serialized.split(";")) if self._favorites_serialized else set()
         return self._favorites
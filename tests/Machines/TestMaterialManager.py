@@ -0,0 +1,386 @@
+# Copyright (c) 2019 Ultimaker B.V.
+# Cura is released under the terms of the LGPLv3 or higher.
+
+from unittest.mock import patch, MagicMock
+import pytest
+
+from cura.Machines.MaterialManager import MaterialManager
+
+
+def createMaterialMetadata(material_id, **kwargs):
+    metadata = {"id": material_id, "type": "material", "base_file": material_id, "brand": "Generic", "definition": "fdmprinter",
+                "material": "PLA", "color_name": "Generic", "approximate_diameter": "3"}
+    metadata.update(kwargs)
+    return metadata
+
+
+def createMockedMaterialContainer(metadata):
+    result = MagicMock()
+    result.getId = MagicMock(return_value = metadata["id"])
+    result.getMetaData = MagicMock(return_value = metadata)
+    return result
+
+
+@pytest.fixture
+def material_metadata():
+    return [createMaterialMetadata("generic_pla"),
+            createMaterialMetadata("generic_pla_175", approximate_diameter = "2"),
+            createMaterialMetadata("generic_pla_175_copy", approximate_diameter = "2")]
+
+
+@pytest.fixture
+def container_registry(material_metadata):
+    result = MagicMock()
+    result.findInstanceContainersMetadata = MagicMock(return_value = material_metadata)
+    return result
+
+
+@pytest.fixture
+def material_manager(application, container_registry):
+    with patch("cura.CuraApplication.CuraApplication.getInstance", MagicMock(return_value = application)):
+        with patch("UM.Settings.ContainerRegistry.ContainerRegistry.getInstance", MagicMock(return_value = container_registry)):
+            return MaterialManager()
+
+
+class TestGetRootMaterialIDForDiameter:
+    def test_sameDiameter(self, material_manager):
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "3") == "generic_pla"
+
+    def test_otherDiameter(self, material_manager):
+        # The first material in registry order with the requested diameter wins.
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "2") == "generic_pla_175"
+
+    def test_unknownDiameter(self, material_manager):
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "1") == "generic_pla"
+
+    def test_materialAdded(self, material_manager):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        material_manager._onContainerChanged(createMockedMaterialContainer(createMaterialMetadata("generic_pla_1", approximate_diameter = "1")))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "1") == "generic_pla_1"
+
+    def test_materialRemoved(self, material_manager, material_metadata):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        material_manager._onContainerRemoved(createMockedMaterialContainer(material_metadata[1]))
+        material_manager._onContainerRemoved(createMockedMaterialContainer(material_metadata[2]))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "2") == "generic_pla"
+
+    def test_hiddenMaterialPromotedAfterRemoval(self, material_manager, material_metadata):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        material_manager._onContainerRemoved(createMockedMaterialContainer(material_metadata[1]))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "2") == "generic_pla_175_copy"
+
+    def test_renamedMaterialKeepsItsPlace(self, material_manager, material_metadata):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        material_metadata[1]["name"] = "Renamed"
+        material_manager._onContainerChanged(createMockedMaterialContainer(material_metadata[1]))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "2") == "generic_pla_175"
+
+    def test_metadataChangedInPlace(self, material_manager, material_metadata):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        # The registry changes the metadata dict itself before the signal arrives.
+        material_metadata[1]["approximate_diameter"] = "1"
+        material_manager._onContainerChanged(createMockedMaterialContainer(material_metadata[1]))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "1") == "generic_pla_175"
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "2") == "generic_pla_175_copy"
+
+    def test_metadataChangedBackKeepsRegistryOrder(self, material_manager, material_metadata):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        material_metadata[1]["approximate_diameter"] = "1"
+        material_manager._onContainerChanged(createMockedMaterialContainer(material_metadata[1]))
+        material_metadata[1]["approximate_diameter"] = "2"
+        material_manager._onContainerChanged(createMockedMaterialContainer(material_metadata[1]))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "2") == "generic_pla_175"
+
+    def test_nonMaterialContainerIgnored(self, material_manager):
+        material_manager.getRootMaterialIDForDiameter("generic_pla", "3")  # Build the lookups.
+        material_manager._onContainerChanged(createMockedMaterialContainer(createMaterialMetadata("some_quality", type = "quality", approximate_diameter = "1")))
+
+        assert material_manager.getRootMaterialIDForDiameter("generic_pla", "1") == "generic_pla"
+
+
+class TestCanMaterialBeRemoved:
+    @staticmethod
+    def createMockedExtruderStack(material_id):
+        result = MagicMock()
+        result.material.getId = MagicMock(return_value = material_id)
+        return result
+
+    @pytest.fixture
+    def material_manager(self, material_manager, material_metadata, container_registry):
+        # A sub-material of generic_pla is active in the only extruder.
+        material_metadata.append(createMaterialMetadata("generic_pla_ultimaker3", base_file = "generic_pla", definition = "ultimaker3"))
+        container_registry.findContainerStacks = MagicMock(return_value = [self.createMockedExtruderStack("generic_pla_ultimaker3")])
+        return material_manager
+
+    def test_subMaterialActive(self, material_manager):
+        assert not material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla"))
+
+    def test_otherMaterial(self, material_manager):
+        assert material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla_175"))
+
+    def test_unknownMaterial(self, material_manager):
+        assert material_manager.canMaterialBeRemoved(MagicMock(base_file = "unknown_material"))
+
+    def test_subMaterialRemoved(self, material_manager, material_metadata):
+        material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla"))  # Build the lookups.
+        material_manager._onContainerRemoved(createMockedMaterialContainer(material_metadata[-1]))
+
+        assert material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla"))
+
+    def test_baseFileChanged(self, material_manager, material_metadata):
+        material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla"))  # Build the lookups.
+        material_metadata[-1]["base_file"] = "generic_pla_175"
+        material_manager._onContainerChanged(createMockedMaterialContainer(material_metadata[-1]))
+
+        assert material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla"))
+        assert not material_manager.canMaterialBeRemoved(MagicMock(base_file = "generic_pla_175"))
+
+
+class TestGetFallBackMaterialIdsByMaterial:
+    @staticmethod
+    def createMockedMaterialGroup(name, is_read_only):
+        result = MagicMock()
+        result.name = name
+        result.is_read_only = is_read_only
+        return result
+
+    @pytest.fixture
+    def material(self):
+        metadata = {"GUID": "some_guid", "material": "PLA"}
+        result = MagicMock()
+        result.getId = MagicMock(return_value = "self")
+        result.getMetaDataEntry = MagicMock(side_effect = lambda key: metadata.get(key))
+        return result
+
+    @pytest.fixture
+    def material_manager(self, material_manager):
+        material_manager._fb_ids = ["generic_pla_175"]
+        material_manager._fb_type_to_idx = {"PLA": 0}
+        material_manager._diameter_material_map = {"generic_pla_175": "generic_pla"}
+        return material_manager
+
+    def test_order(self, material_manager, material):
+        # Read-only groups go first in reverse order, then the others, then the fallback for the material type.
+        material_manager._guid_flat = tuple(self.createMockedMaterialGroup(name, is_read_only) for name, is_read_only in
+                                            [("self", False), ("r1", True), ("w1", False), ("r2", True)])
+        material_manager._guid_ranges = {"some_guid": (0, 4)}
+
+        assert material_manager.getFallBackMaterialIdsByMaterial(material) == ["r2", "r1", "w1", "generic_pla"]
+
+    def test_unknownGUID(self, material_manager, material):
+        material_manager._guid_flat = (self.createMockedMaterialGroup("r1", True), )
+        material_manager._guid_ranges = {"other_guid": (0, 1)}
+
+        assert material_manager.getFallBackMaterialIdsByMaterial(material) == ["generic_pla"]
+
+
+class TestMaterialsUpdated:
+    def test_changesCompressed(self, material_manager):
+        materials_updated = MagicMock()
+        material_manager.materialsUpdated.connect(materials_updated)
+        timer = material_manager._update_timer
+        timer.start = MagicMock(wraps = timer.start)
+
+        for material_id in ["generic_pla_1", "generic_pla_2", "generic_pla_3"]:
+            material_manager._onContainerChanged(createMockedMaterialContainer(createMaterialMetadata(material_id)))
+        timer.start.assert_called_once_with()
+        materials_updated.assert_not_called()  # Not before the timer runs out.
+
+        timer.stop()
+        timer.timeout.emit()
+        materials_updated.assert_called_once_with()
+
+
+class TestFavorites:
+    def test_addFavoriteStoresPreferenceRightAway(self, material_manager, application):
+        application.getPreferences().getValue = MagicMock(return_value = "generic_abs")
+        material_manager.addFavorite("generic_pla")
+
+        application.getPreferences().setValue.assert_called_once_with("cura/favorite_materials", "generic_abs;generic_pla")
+        application.saveSettings.assert_not_called()  # Writing to disk is delayed.
+        assert material_manager.getFavorites() == {"generic_abs", "generic_pla"}
+
+    def test_removeFavoriteStoresPreferenceRightAway(self, material_manager, application):
+        application.getPreferences().getValue = MagicMock(return_value = "generic_abs;generic_pla")
+        material_manager.removeFavorite("generic_abs")
+
+        application.getPreferences().setValue.assert_called_once_with("cura/favorite_materials", "generic_pla")
+        assert material_manager.getFavorites() == {"generic_pla"}
+
+    def test_flushFavoritesSavesSettings(self, material_manager, application):
+        application.getPreferences().getValue = MagicMock(return_value = "")
+        material_manager.materialsUpdated = MagicMock()
+        material_manager.addFavorite("generic_pla")
+        material_manager._flushFavorites()
+
+        application.saveSettings.assert_called_once_with()
+        material_manager.materialsUpdated.emit.assert_called_once_with()
+
+    def test_favoritesChangedByOthers(self, material_manager, application):
+        application.getPreferences().getValue = MagicMock(return_value = "generic_pla")
+        assert material_manager.getFavorites() == {"generic_pla"}
+
+        application.getPreferences().getValue = MagicMock(return_value = "generic_pla;generic_abs")
+        material_manager._onPreferenceChanged("cura/favorite_materials")
+
+        assert material_manager.getFavorites() == {"generic_pla", "generic_abs"}
+
+
+class TestMaterialDiameterCache:
+    def test_diameterConverted(self, material_manager):
+        material_manager._buildMaterialLookups()
+        assert material_manager._material_diameter_f["generic_pla"] == 3.0
+
+    @pytest.mark.parametrize("approximate_diameter", ["missing", None, "", "thick"])
+    def test_missingOrInvalidDiameterSkipped(self, material_manager, approximate_diameter):
+        material_manager._buildMaterialLookups()
+        metadata = createMaterialMetadata("empty_material")
+        if approximate_diameter == "missing":
+            del metadata["approximate_diameter"]
+        else:
+            metadata["approximate_diameter"] = approximate_diameter
+        material_manager._onContainerChanged(createMockedMaterialContainer(metadata))
+
+        assert "empty_material" not in material_manager._material_diameter_f
+
+    def test_diameterUpdatedInPlace(self, material_manager, material_metadata):
+        material_manager._buildMaterialLookups()
+        material_metadata[0]["approximate_diameter"] = "2"
+        material_manager._onContainerChanged(createMockedMaterialContainer(material_metadata[0]))
+
+        assert material_manager._material_diameter_f["generic_pla"] == 2.0
+
+
+class TestDiameterCache:
+    @staticmethod
+    def createMockedExtruderStack(material_diameter):
+        result = MagicMock()
+        result.getCompatibleMaterialDiameter = MagicMock(return_value = material_diameter)
+        return result
+
+    def test_diameterCached(self, material_manager):
+        extruder_stack = self.createMockedExtruderStack(2.85)
+
+        assert material_manager._computeAndCacheDiameter(extruder_stack) == 3
+        assert material_manager._diameter_cache.get(extruder_stack) == 3
+
+    def test_signalsConnectedOnce(self, material_manager):
+        extruder_stack = self.createMockedExtruderStack(2.85)
+        material_manager._computeAndCacheDiameter(extruder_stack)
+        material_manager._diameter_cache.clear()
+        material_manager._computeAndCacheDiameter(extruder_stack)
+
+        extruder_stack.compatibleMaterialDiameterChanged.connect.assert_called_once_with(material_manager._onExtruderCompatibleMaterialDiameterChanged)
+        extruder_stack.containersChanged.connect.assert_called_once_with(material_manager._onExtruderContainersChanged)
+
+    def test_invalidatedOnCompatibleMaterialDiameterChanged(self, material_manager):
+        extruder_stack = self.createMockedExtruderStack(2.85)
+        material_manager._computeAndCacheDiameter(extruder_stack)
+
+        extruder_stack.getCompatibleMaterialDiameter = MagicMock(return_value = 1.75)
+        material_manager._onExtruderCompatibleMaterialDiameterChanged()
+
+        assert material_manager._diameter_cache.get(extruder_stack) is None
+        assert material_manager._computeAndCacheDiameter(extruder_stack) == 2
+
+    def test_invalidatedOnContainersChanged(self, material_manager):
+        extruder_stack = self.createMockedExtruderStack(2.85)
+        material_manager._computeAndCacheDiameter(extruder_stack)
+        material_manager._onExtruderContainersChanged(MagicMock())
+
+        assert material_manager._diameter_cache.get(extruder_stack) is None
+
+    def test_otherPropertyChangeKeepsCache(self, material_manager):
+        extruder_stack = self.createMockedExtruderStack(2.85)
+        material_manager._computeAndCacheDiameter(extruder_stack)
+        material_manager._onExtruderPropertyChanged("layer_height", "value")
+
+        assert material_manager._diameter_cache.get(extruder_stack) == 3
+
+
+@pytest.fixture
+def container_tree():
+    material_node = MagicMock(name = "generic_pla")
+    variant_node = MagicMock()
+    variant_node.materials = {"generic_pla": material_node}
+    machine_node = MagicMock()
+    machine_node.variants = {"AA 0.4": variant_node}
+    result = MagicMock()
+    result.machines = {"ultimaker3": machine_node}
+    return result
+
+
+@pytest.fixture
+def global_stack():
+    extruder_stack = MagicMock()
+    extruder_stack.variant.getName = MagicMock(return_value = "AA 0.4")
+    result = MagicMock()
+    result.definition.getId = MagicMock(return_value = "ultimaker3")
+    result.extruders = {"0": extruder_stack}
+    return result
+
+
+class TestGetMaterialNode:
+    def test_found(self, material_manager, container_tree):
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            result = material_manager.getMaterialNode("ultimaker3", "AA 0.4", None, 3, "generic_pla")
+        assert result is container_tree.machines["ultimaker3"].variants["AA 0.4"].materials["generic_pla"]
+
+    @pytest.mark.parametrize("machine_definition_id, nozzle_name, root_material_id, message", [
+        ("unknown_machine", "AA 0.4", "generic_pla", "Could not find machine"),
+        ("ultimaker3", "unknown_nozzle", "generic_pla", "Could not find variant"),
+        ("ultimaker3", "AA 0.4", "unknown_material", "Could not find material")
+    ])
+    def test_missing(self, material_manager, container_tree, machine_definition_id, nozzle_name, root_material_id, message):
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            with patch("UM.Logger.Logger.log") as mocked_log:
+                result = material_manager.getMaterialNode(machine_definition_id, nozzle_name, None, 3, root_material_id)
+        assert result is None
+        mocked_log.assert_called_once()
+        assert mocked_log.call_args[0][1].startswith(message)
+
+
+class TestGetMaterialNodeByType:
+    def test_found(self, material_manager, container_tree, global_stack):
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            result = material_manager.getMaterialNodeByType(global_stack, "0", "AA 0.4", None, "generic_pla")
+        assert result is container_tree.machines["ultimaker3"].variants["AA 0.4"].materials["generic_pla"]
+
+    def test_materialMissing(self, material_manager, container_tree, global_stack):
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            with patch("UM.Logger.Logger.log") as mocked_log:
+                result = material_manager.getMaterialNodeByType(global_stack, "0", "AA 0.4", None, "unknown_material")
+        assert result is None
+        assert mocked_log.call_args[0][1].startswith("Could not find material")
+
+    def test_variantMissing(self, material_manager, container_tree, global_stack):
+        global_stack.extruders["0"].variant.getName = MagicMock(return_value = "unknown_nozzle")
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            with patch("UM.Logger.Logger.log") as mocked_log:
+                result = material_manager.getMaterialNodeByType(global_stack, "0", "AA 0.4", None, "generic_pla")
+        assert result is None
+        assert mocked_log.call_args[0][1].startswith("Could not find variant")
+
+
+class TestGetDefaultMaterial:
+    def test_unknownNozzleWithoutMaterials(self, material_manager, container_tree, global_stack):
+        # Falls back to the first variant, and then the first material node in it.
+        global_stack.getMetaDataEntry = MagicMock(return_value = False)  # For the "has_materials" metadata.
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            result = material_manager.getDefaultMaterial(global_stack, "0", "unknown_nozzle")
+        assert result is container_tree.machines["ultimaker3"].variants["AA 0.4"].materials["generic_pla"]
+
+    def test_preferredMaterial(self, material_manager, container_tree, global_stack):
+        global_stack.getMetaDataEntry = MagicMock(return_value = True)  # For the "has_materials" metadata.
+        global_stack.extruders["0"].getCompatibleMaterialDiameter = MagicMock(return_value = 2.85)
+        variant_node = container_tree.machines["ultimaker3"].variants["AA 0.4"]
+        with patch("cura.Machines.ContainerTree.ContainerTree.getInstance", MagicMock(return_value = container_tree)):
+            result = material_manager.getDefaultMaterial(global_stack, "0", "AA 0.4")
+        variant_node.preferredMaterial.assert_called_once_with(3)
+        assert result is variant_node.preferredMaterial.return_value